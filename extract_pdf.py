@@ -1,41 +1,236 @@
 import argparse
+import multiprocessing
 import os
+import cv2
+import queue
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import paddle
+import pymupdf
 from paddleocr import PaddleOCR
-from pdf2image import convert_from_path
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import tempfile
 import numpy
 
-def extract_text_from_pdf(pdf_path: str) -> str:
+# 渲染队列容量：限制已渲染但尚未识别的页面数量
+RENDER_QUEUE_SIZE = 4
+
+# 默认每批送入OCR的页数
+DEFAULT_BATCH_SIZE = 8
+
+# 渲染页面图片的默认分辨率
+DEFAULT_DPI = 150
+
+# 识别出的文本框少于 MIN_OCR_BOXES 的页面，以 RETRY_DPI 重新渲染识别
+MIN_OCR_BOXES = 3
+RETRY_DPI = 300
+
+# 文本层字符数超过该值的页面视为已有文本，直接读取而不做OCR
+TEXT_LAYER_MIN_CHARS = 50
+
+# clean_text 使用的预编译模式：行内连续空白、列表项开头、零宽字符
+_WS = re.compile(r'\s+')
+# 列表项：•开头；-、*后跟空白；数字编号后不能紧跟数字（排除 3.14、2024.10 等小数和日期）
+_BULLET = re.compile(r'^(?:•|[\-*]\s|\d+\.(?!\d))')
+_ZERO_WIDTH = str.maketrans('', '', '\u200b\u200c\u200d\u2060\ufeff')
+
+# 每个工作进程持有的PaddleOCR实例，由 _init_ocr_worker 初始化
+_ocr = None
+
+# 每个工作进程打开的PDF文档，由 _init_text_worker 初始化
+_doc = None
+
+def _build_ocr_options(fast: bool = False) -> Dict:
     """
-    使用PaddleOCR从PDF文件中提取文本
+    构造PaddleOCR初始化参数（PaddleOCR 2.x），有GPU时使用GPU，fast模式下另启用TensorRT和FP16
     """
-    try:
-        # 初始化PaddleOCR
-        ocr = PaddleOCR(use_angle_cls=True, lang='ch', show_log=False)
+    # PaddleOCR 2.x在CUDA版paddle上默认use_gpu=True，这里显式指定，便于按是否使用GPU决定进程数
+    use_gpu = paddle.device.is_compiled_with_cuda() and paddle.device.cuda.device_count() > 0
+    options = dict(use_angle_cls=True, lang='ch', show_log=False, use_gpu=use_gpu,
+                   rec_batch_num=32, max_batch_size=32)
+    if fast and use_gpu:
+        # FP16仅在TensorRT下生效
+        options.update(use_tensorrt=True, precision='fp16')
+    return options
+
+def _init_ocr_worker(options: Dict, page_shape: Tuple[int, int, int]) -> None:
+    """
+    工作进程初始化：每个进程只加载一次OCR模型并预热
+    """
+    global _ocr
+    _ocr = PaddleOCR(**options)
+    
+    # 预热，避免首页承担模型初始化开销；启用TensorRT时按实际页面尺寸再预热两次，
+    # 使动态shape优化覆盖真实输入
+    warmup_shapes = [(640, 640, 3)]
+    if options.get('use_tensorrt'):
+        warmup_shapes += [page_shape] * 2
+    for shape in warmup_shapes:
+        try:
+            _ocr.ocr(numpy.zeros(shape, dtype=numpy.uint8))
+        except Exception:
+            # 空白图片可能没有检测结果，预热失败不影响后续识别
+            pass
+
+def _ocr_pages(pages: List[Tuple[int, str]], dpi: int = DEFAULT_DPI) -> List[Tuple[int, str, int]]:
+    """
+    在工作进程中识别一组以dpi渲染的页面图片文件，返回 [(页码, 页面文本, 文本框数量), ...]
+    """
+    page_results = []
+    for page_index, image_path in pages:
+        # 直接从磁盘读取为连续的BGR数组，读取后即删除临时图片
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if os.path.exists(image_path):
+            os.remove(image_path)
         
-        # 将PDF转换为图片
-        print("正在将PDF转换为图片...")
-        images = convert_from_path(pdf_path)
+        # 图片缺失或无法读取时该页返回空结果，不影响同组其他页面
+        if image is None:
+            page_results.append((page_index, "", 0))
+            continue
         
-        # 存储提取的文本
-        extracted_text = ""
+        # PaddleOCR 2.x开启检测时ocr()不支持传入图片列表（会直接exit），只能逐页调用
+        result = _ocr.ocr(image, cls=True)[0]
+        page_results.append((page_index, process_ocr_result(result, dpi) if result else "", len(result or [])))
+    return page_results
+
+def _render_page(page, image_path: str, dpi: int) -> None:
+    """
+    将单页渲染为图片文件，页面内图片均为灰度（黑白扫描件）时按灰度渲染
+    """
+    images = page.get_images(full=True)
+    grayscale = bool(images) and all(image[5] == 'DeviceGray' for image in images)
+    colorspace = pymupdf.csGRAY if grayscale else pymupdf.csRGB
+    page.get_pixmap(dpi=dpi, colorspace=colorspace).save(image_path)
+
+def _render_pages(pdf_path: str, output_folder: str, page_queue: queue.Queue, text_pages: Dict[int, str],
+                  errors: List[Exception], force_ocr: bool = False, dpi: int = DEFAULT_DPI) -> None:
+    """
+    渲染线程：已有文本层的页面直接读取文本，其余页面渲染为图片文件并将路径放入队列，结束时放入None
+    """
+    try:
+        with pymupdf.open(pdf_path) as doc:
+            for i, page in enumerate(doc, 1):
+                # 已有文本层的页面跳过渲染和OCR
+                if not force_ocr:
+                    text = page.get_text("text")
+                    if len(text.strip()) > TEXT_LAYER_MIN_CHARS:
+                        text_pages[i] = clean_text(text)
+                        continue
+                
+                image_path = os.path.join(output_folder, f"page-{i}.jpg")
+                _render_page(page, image_path, dpi)
+                page_queue.put((i, image_path))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        page_queue.put(None)
+
+def extract_text_from_pdf(pdf_path: str, fast: bool = False, batch_size: int = DEFAULT_BATCH_SIZE,
+                          force_ocr: bool = False, dpi: int = DEFAULT_DPI) -> str:
+    """
+    使用PaddleOCR从PDF文件中提取文本，已有文本层的页面直接读取（force_ocr时全部OCR）
+    """
+    try:
+        with pymupdf.open(pdf_path) as doc:
+            total_pages = doc.page_count
+            # 按首页尺寸估算渲染后的图片大小，用于模型预热
+            first_page = doc[0].rect
+            page_shape = (round(first_page.height * dpi / 72), round(first_page.width * dpi / 72), 3)
         
-        # 逐页处理
-        for i, image in enumerate(images, 1):
-            print(f"正在处理第 {i}/{len(images)} 页...")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # 启动渲染线程，边渲染边识别
+            # 页面渲染到临时目录，进程间只传递文件路径，避免序列化整张图片
+            print("正在将PDF转换为图片...")
+            page_queue = queue.Queue(maxsize=RENDER_QUEUE_SIZE)
+            render_errors = []
+            text_pages = {}
+            renderer = threading.Thread(
+                target=_render_pages,
+                args=(pdf_path, tmp_dir, page_queue, text_pages, render_errors, force_ocr, dpi),
+                daemon=True
+            )
+            renderer.start()
+            
+            # 多进程并行处理各页，每个进程各自初始化PaddleOCR
+            # 使用GPU时只启动一个进程，避免多个进程在同一块GPU上各自加载模型、构建TensorRT引擎
+            ocr_options = _build_ocr_options(fast)
+            max_workers = 1 if ocr_options.get('use_gpu') else max(1, (os.cpu_count() or 2) // 2)
+            page_texts = {}
+            page_boxes = {}
             
-            # 使用OCR识别文本
-            result = ocr.ocr(numpy.array(image))
+            def collect(futures) -> None:
+                for future in futures:
+                    try:
+                        results = future.result()
+                    except SystemExit as e:
+                        # 工作进程中的exit()会经future传回，转为异常以免程序以状态0退出
+                        raise RuntimeError(f"OCR识别进程异常退出 (退出码: {e.code})") from e
+                    
+                    for i, page_text, boxes in results:
+                        # 重新识别的结果仅在文本框不少于原结果时采用
+                        if boxes >= page_boxes.get(i, 0):
+                            page_texts[i] = page_text
+                            page_boxes[i] = boxes
+                    print(f"已识别 {len(page_texts)} 页...")
             
-            if result[0]:
-                # 提取当前页面的文本
-                page_text = process_ocr_result(result[0])
+            # 检测GPU时主进程已初始化CUDA，fork出的子进程无法复用CUDA上下文，因此以spawn方式启动
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_ocr_worker,
+                                     initargs=(ocr_options, page_shape)) as executor:
+                pending = set()
+                batch = []
+                while True:
+                    item = page_queue.get()
+                    if item is not None:
+                        batch.append(item)
+                    
+                    # 凑满一批（或渲染结束）后整批提交识别
+                    if batch and (len(batch) >= batch_size or item is None):
+                        pending.add(executor.submit(_ocr_pages, batch, dpi))
+                        batch = []
+                    
+                    if item is None:
+                        break
+                    
+                    # 限制在途批次数量，避免渲染结果在进程池中堆积
+                    if len(pending) >= max_workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
                 
-                # 只有当文本非空时才添加页面
-                if page_text.strip():
-                    extracted_text += f"### Page {i}\n\n"
-                    extracted_text += page_text + "\n\n"
+                collect(wait(pending)[0])
+                
+                renderer.join()
+                if render_errors:
+                    raise render_errors[0]
+                
+                # 识别出的文本框过少的页面，提高分辨率重新识别
+                retry_pages = sorted(i for i, boxes in page_boxes.items() if boxes < MIN_OCR_BOXES)
+                if retry_pages and dpi < RETRY_DPI:
+                    print(f"{len(retry_pages)} 页识别结果过少，以 {RETRY_DPI} DPI 重新识别...")
+                    with pymupdf.open(pdf_path) as doc:
+                        retry_items = []
+                        for i in retry_pages:
+                            image_path = os.path.join(tmp_dir, f"page-{i}-retry.jpg")
+                            _render_page(doc[i - 1], image_path, RETRY_DPI)
+                            retry_items.append((i, image_path))
+                    
+                    retry_futures = [
+                        executor.submit(_ocr_pages, retry_items[k:k + batch_size], RETRY_DPI)
+                        for k in range(0, len(retry_items), batch_size)
+                    ]
+                    collect(wait(retry_futures)[0])
+        
+        print(f"共 {total_pages} 页：{len(text_pages)} 页读取文本层，{len(page_texts)} 页OCR识别")
+        page_texts.update(text_pages)
+        
+        # 按页码排序后拼接，只保留非空页面
+        extracted_text = "".join(
+            f"### Page {i}\n\n{page_texts[i]}\n\n"
+            for i in sorted(page_texts)
+            if page_texts[i].strip()
+        )
         
         return extracted_text.strip()
             
@@ -43,39 +238,86 @@ def extract_text_from_pdf(pdf_path: str) -> str:
         print(f"处理PDF时发生错误: {str(e)}")
         return None
 
-def process_ocr_result(result: List[Dict]) -> str:
+def _init_text_worker(pdf_path: str) -> None:
     """
-    处理OCR识别结果，将其转换为格式化文本
+    工作进程初始化：每个进程只打开一次PDF文档
     """
-    # 按照y坐标排序，确保文本按照从上到下的顺序
-    sorted_text = sorted(result, key=lambda x: x[0][0][1])  # 根据第一个点的y坐标排序
-    
-    # 提取文本并合并
-    text_lines = []
-    current_line = []
-    current_y = None
-    y_threshold = 10  # y坐标差异阈值，用于判断是否为同一行
+    global _doc
+    _doc = pymupdf.open(pdf_path)
+
+def _extract_one(page_index: int) -> Tuple[int, str]:
+    """
+    在工作进程中读取单页文本层，返回 (页码, 清理后的文本)，页码从1开始
+    """
+    page = _doc.load_page(page_index - 1)
+    return page_index, clean_text(page.get_text("text"))
+
+def extract_text_layer_from_pdf(pdf_path: str, threads: Optional[int] = None) -> str:
+    """
+    使用PyMuPDF直接读取PDF文本层，适用于非扫描版PDF
+    """
+    try:
+        with pymupdf.open(pdf_path) as doc:
+            total_pages = doc.page_count
+        
+        # 多进程并行读取各页，每个进程各自打开文档
+        parts = []
+        with ProcessPoolExecutor(max_workers=threads or os.cpu_count(),
+                                 initializer=_init_text_worker,
+                                 initargs=(pdf_path,)) as executor:
+            results = executor.map(_extract_one, range(1, total_pages + 1), chunksize=4)
+            for i, page_text in results:
+                print(f"已处理 {i}/{total_pages} 页...")
+                
+                # 只有当文本非空时才添加页面
+                if page_text:
+                    parts.append(f"### Page {i}\n\n{page_text}\n\n")
+        
+        return "".join(parts).strip()
     
-    for box in sorted_text:
-        text = box[1][0]  # 获取识别的文本
-        y_coord = box[0][0][1]  # 获取文本框的y坐标
+    except Exception as e:
+        print(f"处理PDF时发生错误: {str(e)}")
+        return None
+
+def clean_text(text: str) -> str:
+    """
+    清理文本层提取的文本：合并多余空白、去除空行，列表项单独成段
+    """
+    lines = []
+    for line in text.translate(_ZERO_WIDTH).splitlines():
+        line = _WS.sub(' ', line).strip()
+        if not line:
+            continue
         
-        if current_y is None:
-            current_y = y_coord
-            current_line.append(text)
-        else:
-            # 如果y坐标相近，认为是同一行
-            if abs(y_coord - current_y) <= y_threshold:
-                current_line.append(text)
-            else:
-                # 开始新的一行
-                text_lines.append(' '.join(current_line))
-                current_line = [text]
-                current_y = y_coord
+        # 列表项前空一行，避免与上一段粘连
+        if lines and _BULLET.match(line):
+            lines.append('')
+        lines.append(line)
     
-    # 添加最后一行
-    if current_line:
-        text_lines.append(' '.join(current_line))
+    return '\n'.join(lines)
+
+def process_ocr_result(result: List[Dict], dpi: int = 200) -> str:
+    """
+    处理OCR识别结果，将其转换为格式化文本，dpi为页面图片的渲染分辨率
+    """
+    if not result:
+        return ""
+    
+    # 取每个文本框第一个点的坐标和识别的文本
+    ys = numpy.fromiter((box[0][0][1] for box in result), dtype=numpy.float32, count=len(result))
+    xs = numpy.fromiter((box[0][0][0] for box in result), dtype=numpy.float32, count=len(result))
+    texts = [box[1][0] for box in result]
+    y_threshold = 10 * dpi / 200  # y坐标差异阈值，用于判断是否为同一行；10像素按200 DPI标定，随分辨率缩放
+    
+    # 按照y坐标排序，相邻y坐标差异超过阈值处断开为新的一行
+    order = numpy.argsort(ys, kind='stable')
+    line_breaks = numpy.where(numpy.diff(ys[order]) > y_threshold)[0] + 1
+    
+    # 每行内按照x坐标从左到右排列
+    text_lines = []
+    for line in numpy.split(order, line_breaks):
+        line = line[numpy.argsort(xs[line], kind='stable')]
+        text_lines.append(' '.join(texts[j] for j in line))
     
     return '\n\n'.join(text_lines)
 
@@ -83,6 +325,20 @@ def main():
     parser = argparse.ArgumentParser(description='从PDF文件中提取文本')
     parser.add_argument('pdf_path', help='输入PDF文件路径')
     parser.add_argument('output_path', nargs='?', help='输出文本文件路径（可选，默认与PDF同名）')
+    parser.add_argument('--engine',
+                       choices=['ocr', 'text'],
+                       default='ocr',
+                       help='提取方式：ocr(PaddleOCR识别页面图片) 或 text(直接读取PDF文本层)')
+    parser.add_argument('--force-ocr', action='store_true',
+                       help='ocr方式下对所有页面执行OCR，不直接读取已有文本层')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                       help='text方式下并行读取的进程数（默认：CPU核数）')
+    parser.add_argument('--dpi', type=int, default=DEFAULT_DPI,
+                       help=f'ocr方式下渲染页面图片的分辨率（默认：{DEFAULT_DPI}），识别结果过少的页面会以{RETRY_DPI} DPI重试')
+    parser.add_argument('--fast', action='store_true',
+                       help='有GPU时使用TensorRT和FP16（单进程），仅有CPU时无效果')
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH_SIZE,
+                       help=f'每个OCR识别任务包含的页数（默认：{DEFAULT_BATCH_SIZE}）')
     
     args = parser.parse_args()
     
@@ -97,7 +353,11 @@ def main():
     try:
         # 读取PDF文件
         print(f"正在读取PDF文件: {args.pdf_path}")
-        text = extract_text_from_pdf(args.pdf_path)
+        if args.engine == 'text':
+            text = extract_text_layer_from_pdf(args.pdf_path, threads=args.threads)
+        else:
+            text = extract_text_from_pdf(args.pdf_path, fast=args.fast, batch_size=args.batch,
+                                         force_ocr=args.force_ocr, dpi=args.dpi)
         
         if text:
             # 保存文本
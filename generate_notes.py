@@ -1,96 +1,70 @@
-import json
 import argparse
+import itertools
+import mmap
 import os
-from typing import List, Dict, Optional
+import re
+from contextlib import nullcontext
+from typing import Callable, List, Optional, Tuple
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import tiktoken
 from tqdm import tqdm
 import time
-import sys
-
-class StatsDisplay:
-    """统计信息显示管理器"""
-    def __init__(self):
-        self.stats_lines = 11  # 统计信息的总行数
-        self.initialized = False
-        self.last_content = ""  # 记录上一次的统计内容
-        
-    def init_display(self):
-        """初始化显示区域"""
-        if not self.initialized:
-            # 为统计信息预留空间
-            print("\n" * (self.stats_lines + 1))  # 多预留一行作为缓冲
-            sys.stdout.write(f"\033[{self.stats_lines + 1}A")
-            sys.stdout.flush()
-            self.initialized = True
-    
-    def get_cursor_position(self) -> int:
-        """获取当前光标位置"""
-        import os
-        try:
-            # 尝试获取终端大小
-            rows, _ = os.popen('stty size', 'r').read().split()
-            return int(rows)
-        except:
-            return 0
-    
-    def update_stats(self, stats: Dict):
-        """更新统计信息显示"""
-        if not self.initialized:
-            self.init_display()
-            return
-        
-        # 格式化统计信息
-        stats_text = (
-            "="*50 + "\n"
-            f"API调用统计:\n"
-            f"总调用次数: {stats['api_calls']}次\n\n"
-            f"Token消耗统计:\n"
-            f"输入Token数: {stats['prompt_tokens']:,}\n"
-            f"输出Token数: {stats['completion_tokens']:,}\n"
-            f"总Token数: {stats['total_tokens']:,}\n\n"
-            f"费用统计: ¥{stats['total_cost']:.4f}\n"
-            + "="*50
-        )
-        
-        # 如果内容没有变化，不更新
-        if stats_text == self.last_content:
-            return
-            
-        # 保存当前内容
-        self.last_content = stats_text
-        
-        # 移动到统计信息区域起始位置
-        sys.stdout.write(f"\033[{self.stats_lines + 1}A")
-        
-        # 清除并更新统计信息
-        lines = stats_text.split('\n')
-        for i, line in enumerate(lines):
-            sys.stdout.write("\033[2K")  # 清除当前行
-            if i < len(lines) - 1:
-                print(line)
-            else:
-                print(line, end='')
-        
-        # 移动回进度条位置
-        sys.stdout.write(f"\033[{self.stats_lines - len(lines) + 1}B")
-        sys.stdout.flush()
-
-    def cleanup(self):
-        """清理显示"""
-        if self.initialized:
-            sys.stdout.write(f"\033[{self.stats_lines + 1}A")  # 移动到统计信息开始处
-            for _ in range(self.stats_lines + 1):  # 多清理一行
-                sys.stdout.write("\033[2K\n")
-            sys.stdout.write(f"\033[{self.stats_lines + 2}A")  # 多回退一行
-            sys.stdout.flush()
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# 页面内容：从 "### Page N" 标题行之后到下一个页面标题（或文件末尾）
+PAGE_PATTERN = re.compile(rb'### Page[^\n]*\n(.*?)(?=### Page|\Z)', re.DOTALL)
+_NON_SPACE = re.compile(rb'\S')
+
+# 内容分析的结构和要求，单页和多页提示词共用
+ANALYSIS_INSTRUCTIONS = """请按照以下结构进行内容分析和总结， 需避免单纯的列表罗列：
+
+### 概念解释
+请提取并解释文中最关键的2-3个技术概念或术语，确保解释准确且易于理解。每个概念解释应包含：
+
+### 技术挑战
+分析文中描述的主要技术挑战，以及传统解决方案的局限性
+
+### 解决方案
+详细分析文中提出的解决方案：
+- 核心技术架构
+- 关键实现方法
+
+### 方案优势
+系统总结该方案的优势
+
+### 最佳实践
+总结相关领域的实践经验
+
+要求：
+- 分析要准确、客观，避免主观臆测
+- 重点突出技术本质和创新点
+- 保持专业性的同时确保表述清晰
+- 适当补充相关领域的专业见解
+- 每个部分都需要完整的语段阐述，而不是简单列举
+
+请基于文本内容进行分析，如有不足之处，可以基于专业知识适当补充，但要明确区分原文信息和补充信息。
+"""
+
+# 每页笔记的提示词模板，{topic} 和 {text} 为占位符
+PROMPT_TEMPLATE = """作为一位专业的技术分析专家，请帮助我深入理解以下内容。
+
+主题方向：{topic}
+
+源内容：
+{text}
+
+""" + ANALYSIS_INSTRUCTIONS
 
 class NotesGenerator:
     def __init__(self, config_path: str):
         """初始化生成器"""
         # 加载配置
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = json.load(f)
+        with open(config_path, 'rb') as f:
+            self.config = orjson.loads(f.read())
         
         # 初始化tokenizer，使用cl100k_base编码器
         try:
@@ -109,80 +83,133 @@ class NotesGenerator:
             'api_calls': 0,
             'last_update': time.time()
         }
-        self.stats_display = StatsDisplay()
+        # 并发调用API时保护用量统计
+        self.stats_lock = threading.Lock()
+        
+        # 复用HTTP连接，连接失败和限流、服务端错误按指数退避重试；
+        # 读取错误和超时不重试（read=False直接抛出原异常，超时仍为Timeout），避免重复发送可能已计费的请求
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.config['api_key']}",
+            "Content-Type": "application/json"
+        })
+        pool_size = max(16, self.config.get('concurrency', 8))
+        retries = Retry(total=3,
+                        backoff_factor=0.5,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        read=False,
+                        allowed_methods=frozenset({'POST'}),
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         
         # 设置日志级别
         self.log_level = self.config.get('log_level', 'info').lower()
+        
+        # 预先按占位符切分提示词模板，生成提示词时只需拼接
+        prefix, rest = PROMPT_TEMPLATE.split("{topic}")
+        middle, suffix = rest.split("{text}")
+        self._prompt_parts = (prefix, middle, suffix)
 
     def count_tokens(self, text: str) -> int:
         """计算文本的token数量"""
+        return self.count_tokens_batch([text])[0]
+    
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """批量计算多段文本的token数量，由tiktoken多线程编码"""
         if self.tokenizer:
-            return len(self.tokenizer.encode(text))
+            encoded = self.tokenizer.encode_ordinary_batch(texts, num_threads=os.cpu_count() or 1)
+            return [len(tokens) for tokens in encoded]
         else:
             # 后备方案：使用字符数除以4作为估算（这是一个粗略的估计）
-            return len(text) // 4
+            return [len(text) // 4 for text in texts]
     
     def create_prompt(self, text: str, topic: str) -> str:
         """创建提示词"""
-        return f"""作为一位专业的技术分析专家，请帮助我深入理解以下内容。
-
-主题方向：{topic}
-
-源内容：
-{text}
-
-请按照以下结构进行内容分析和总结， 需避免单纯的列表罗列：
-
-### 概念解释
-请提取并解释文中最关键的2-3个技术概念或术语，确保解释准确且易于理解。每个概念解释应包含：
-
-### 技术挑战
-分析文中描述的主要技术挑战，以及传统解决方案的局限性
-
-### 解决方案
-详细分析文中提出的解决方案：
-- 核心技术架构
-- 关键实现方法
-
-### 方案优势
-系统总结该方案的优势
+        prefix, middle, suffix = self._prompt_parts
+        return "".join((prefix, topic, middle, text, suffix))
 
-### 最佳实践
-总结相关领域的实践经验
+    def create_batch_prompt(self, texts: List[str], topic: str) -> str:
+        """创建多页合并的提示词，要求模型按页返回JSON数组"""
+        parts = [
+            f"作为一位专业的技术分析专家，请帮助我深入理解以下{len(texts)}页内容。\n\n"
+            f"主题方向：{topic}\n\n"
+            "源内容：\n"
+        ]
+        for k, text in enumerate(texts, 1):
+            parts.append(f"【第{k}页】\n{text}\n\n")
+        parts.append("请对每一页分别进行分析。")
+        parts.append(ANALYSIS_INSTRUCTIONS)
+        parts.append(
+            "\n输出格式：\n"
+            f"只输出一个JSON字符串数组，不要输出其他内容。数组长度必须为{len(texts)}，"
+            "第k个元素是第k页的完整分析（Markdown文本，包含上述各个小节）。\n"
+        )
+        return "".join(parts)
 
-要求：
-- 分析要准确、客观，避免主观臆测
-- 重点突出技术本质和创新点
-- 保持专业性的同时确保表述清晰
-- 适当补充相关领域的专业见解
-- 每个部分都需要完整的语段阐述，而不是简单列举
+    def parse_batch_response(self, response: str, expected: int) -> Optional[List[str]]:
+        """解析多页合并调用返回的JSON数组，格式不符时返回None"""
+        content = response.strip()
+        # 去除可能包裹的Markdown代码块标记
+        if content.startswith("```"):
+            content = content.split("\n", 1)[-1].rsplit("```", 1)[0]
+        
+        try:
+            analyses = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return None
+        
+        if (not isinstance(analyses, list) or len(analyses) != expected
+                or not all(isinstance(analysis, str) for analysis in analyses)):
+            return None
+        return analyses
 
-请基于文本内容进行分析，如有不足之处，可以基于专业知识适当补充，但要明确区分原文信息和补充信息。
-"""
+    def group_by_tokens(self, token_counts: List[int], limit: int, max_items: Optional[int] = None) -> List[List[int]]:
+        """按token累计值将相邻元素分组，返回每组元素的下标列表"""
+        groups = []
+        current = []
+        current_tokens = 0
+        
+        for idx, tokens in enumerate(token_counts):
+            if current_tokens + tokens < limit and (max_items is None or len(current) < max_items):
+                current.append(idx)
+                current_tokens += tokens
+            else:
+                if current:
+                    groups.append(current)
+                current = [idx]
+                current_tokens = tokens
+        
+        if current:
+            groups.append(current)
+            
+        return groups
 
     def chunk_text(self, text: str) -> List[str]:
         """将文本分块，确保每块不超过上下文窗口大小"""
-        pages = text.split("-------\n")
-        chunks = []
-        current_chunk = ""
+        pages = [page for page in text.split("-------\n") if page.strip()]
         
-        for page in pages:
-            if not page.strip():
-                continue
-                
-            # 计算当前chunk加上新页面的token数
-            potential_chunk = current_chunk + page
-            if self.count_tokens(potential_chunk) < self.config['context_window'] - 1000:
-                current_chunk = potential_chunk
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                current_chunk = page
+        # 每页只编码一次，用累计值判断是否超出窗口
+        page_tokens = self.count_tokens_batch(pages)
+        groups = self.group_by_tokens(page_tokens, self.config['context_window'] - 1000)
         
-        if current_chunk:
-            chunks.append(current_chunk)
-            
-        return chunks
+        return ["".join(pages[idx] for idx in group) for group in groups]
+
+    def group_pages(self, page_count: int, read_page: Callable[[int], str]) -> List[List[int]]:
+        """将相邻的短页面合并为一组共用一次API调用，返回各组的页码列表（从1开始）"""
+        # 合并后各页的解读共用一次回复，组内页数还受 max_tokens 能容纳的解读数量限制
+        per_page_budget = self.config.get('output_tokens_per_page', 1500)
+        max_pages = min(self.config.get('pages_per_call', 1), self.config['max_tokens'] // per_page_budget)
+        if max_pages <= 1:
+            return [[i] for i in range(1, page_count + 1)]
+        
+        # 输入需为输出预留max_tokens，并为提示词本身预留空间
+        limit = self.config['context_window'] - self.config['max_tokens'] - 1000
+        page_tokens = self.count_tokens_batch([read_page(i) for i in range(1, page_count + 1)])
+        groups = self.group_by_tokens(page_tokens, limit, max_items=max_pages)
+        
+        return [[idx + 1 for idx in group] for group in groups]
 
     def log_debug(self, message: str):
         """输出调试信息"""
@@ -191,11 +218,11 @@ class NotesGenerator:
 
     def call_llm_api(self, prompt: str) -> str:
         """调用大模型API"""
-        headers = {
-            "Authorization": f"Bearer {self.config['api_key']}",
-            "Content-Type": "application/json"
-        }
-        
+        content, _ = self.call_llm_api_with_finish_reason(prompt)
+        return content
+
+    def call_llm_api_with_finish_reason(self, prompt: str) -> Tuple[str, Optional[str]]:
+        """调用大模型API，同时返回结束原因（如 'length' 表示输出达到max_tokens被截断）"""
         data = {
             "model": self.config['model'],
             "messages": [{"role": "user", "content": prompt}],
@@ -208,15 +235,13 @@ class NotesGenerator:
             self.log_debug(f"\nAPI请求信息:")
             self.log_debug(f"URL: {self.config['api_base']}/chat/completions")
             self.log_debug(f"模型: {self.config['model']}")
-            self.log_debug(f"输入Token数: {self.count_tokens(prompt)}")
             
             # 记录请求开始时间
             start_time = time.time()
             
-            response = requests.post(
+            response = self.session.post(
                 f"{self.config['api_base']}/chat/completions",
-                headers=headers,
-                json=data,
+                data=orjson.dumps(data),
                 timeout=60
             )
             
@@ -225,25 +250,28 @@ class NotesGenerator:
             self.log_debug(f"请求耗时: {elapsed_time:.2f}秒")
             
             if response.status_code == 200:
-                response_data = response.json()
+                response_data = orjson.loads(response.content)
                 # 更新用量统计
                 usage = response_data.get('usage', {})
-                self.usage_stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
-                self.usage_stats['completion_tokens'] += usage.get('completion_tokens', 0)
-                self.usage_stats['total_tokens'] += usage.get('total_tokens', 0)
-                self.usage_stats['api_calls'] += 1
-                
                 # 计算费用
                 cost = (usage.get('total_tokens', 0) / 1_000_000) * self.config['price_per_1m_tokens']
-                self.usage_stats['total_cost'] += cost
+                
+                with self.stats_lock:
+                    self.usage_stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
+                    self.usage_stats['completion_tokens'] += usage.get('completion_tokens', 0)
+                    self.usage_stats['total_tokens'] += usage.get('total_tokens', 0)
+                    self.usage_stats['api_calls'] += 1
+                    self.usage_stats['total_cost'] += cost
                 
                 # 打印响应信息
                 self.log_debug(f"响应状态: 成功")
+                self.log_debug(f"输入Token数: {usage.get('prompt_tokens', 0)}")
                 self.log_debug(f"输出Token数: {usage.get('completion_tokens', 0)}")
                 self.log_debug(f"总Token数: {usage.get('total_tokens', 0)}")
                 self.log_debug(f"本次费用: ¥{cost:.4f}\n")
                 
-                return response_data['choices'][0]['message']['content']
+                choice = response_data['choices'][0]
+                return choice['message']['content'], choice.get('finish_reason')
             else:
                 # 打印错误响应详情
                 error_msg = f"响应状态: 失败 (状态码: {response.status_code})\n错误信息: {response.text}"
@@ -285,65 +313,136 @@ class NotesGenerator:
         """更新进度条中的统计信息"""
         current_time = time.time()
         if current_time - self.usage_stats['last_update'] >= 1.0:
-            pbar.set_postfix_str(self.format_stats(), refresh=True)
+            # 不强制刷新，由tqdm在下次更新进度时统一重绘
+            pbar.set_postfix_str(self.format_stats(), refresh=False)
             self.usage_stats['last_update'] = current_time
 
     def process_file(self, input_path: str, topic: str, error_strategy: str = 'skip') -> None:
         """处理输入文件并生成笔记"""
         print(f"正在读取文件: {input_path}")
-        with open(input_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-        
         output_path = os.path.splitext(input_path)[0] + '_notes.md'
-        pages = text.split('### Page')
-        pages = [page.strip() for page in pages[1:] if page.strip()]
-        
-        print(f"共发现 {len(pages)} 页内容\n")
-        
-        # 创建或清空输出文件
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write("")
         
-        # 创建进度条，添加统计信息
-        with tqdm(total=len(pages), desc="生成笔记", unit="页") as pbar:
-            for i, page_text in enumerate(pages, 1):
-                try:
-                    # 生成当前页的笔记
-                    page_note = self.process_single_page(i, page_text, topic)
+        # 以内存映射方式读取输入文件（空文件无法映射），页面内容在提交处理时才解码
+        with open(input_path, 'rb') as src, \
+                (mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+                 if os.fstat(src.fileno()).st_size else nullcontext(b"")) as mm:
+            # 只记录非空页面在文件中的位置
+            spans = [
+                match.span(1) for match in PAGE_PATTERN.finditer(mm)
+                if _NON_SPACE.search(mm, *match.span(1))
+            ]
+            
+            def read_page(page_num: int) -> str:
+                start, end = spans[page_num - 1]
+                return mm[start:end].decode('utf-8').strip()
+            
+            print(f"共发现 {len(spans)} 页内容\n")
+            
+            notes = {}  # 已完成但尚未写入文件的页面笔记
+            next_page = 1  # 下一个待写入文件的页码
+            max_workers = self.config.get('concurrency', 8)
+            
+            # 创建或清空输出文件，整个处理过程复用同一个文件句柄
+            with open(output_path, 'w', encoding='utf-8', buffering=1 << 20) as f, \
+                    tqdm(total=len(spans), desc="生成笔记", unit="页") as pbar, \
+                    ThreadPoolExecutor(max_workers=max_workers) as executor:
+                groups = iter(self.group_pages(len(spans), read_page))
+                futures = {}
+                
+                while True:
+                    # 并发生成各组页面的笔记，限制在途任务数量，页面按需读取
+                    for group in itertools.islice(groups, max_workers * 2 - len(futures)):
+                        pages = [(i, read_page(i)) for i in group]
+                        futures[executor.submit(self.process_page_group, pages, topic)] = pages
                     
-                    # 实时追加到文件
-                    with open(output_path, 'a', encoding='utf-8') as f:
-                        f.write(page_note)
+                    if not futures:
+                        break
                     
-                    # 更新进度条和统计信息
-                    pbar.update(1)
-                    self.update_progress_stats(pbar)
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pages = futures.pop(future)
+                        group = [i for i, _ in pages]
+                        try:
+                            notes.update(zip(group, future.result()))
+                            
+                        except Exception as e:
+                            page_range = f"{group[0]}" if len(group) == 1 else f"{group[0]}-{group[-1]}"
+                            error_msg = f"处理第 {page_range} 页时发生错误: {str(e)}"
+                            tqdm.write(error_msg)
+                            
+                            if error_strategy == 'abort':
+                                # 取消尚未开始的任务，等待进行中的任务完成，保留已生成的笔记
+                                for pending in futures:
+                                    pending.cancel()
+                                running = [pending for pending in futures if not pending.cancelled()]
+                                wait(running)
+                                for pending in running:
+                                    if pending.exception() is None:
+                                        notes.update(zip((i for i, _ in futures[pending]), pending.result()))
+                                
+                                # 写入出错页面之前已完成的连续页面
+                                while next_page < group[0] and next_page in notes:
+                                    f.write(notes.pop(next_page))
+                                    next_page += 1
+                                raise Exception(f"由于错误策略设置为'abort'，停止处理。最后错误: {str(e)}")
+                            
+                            # 记录错误信息
+                            for i, page_text in pages:
+                                notes[i] = (
+                                    f"# Page {i}\n\n"
+                                    "## 原文\n"
+                                    f"{page_text}\n\n"
+                                    "## 内容解读\n"
+                                    f"生成失败: {str(e)}\n\n"
+                                )
                         
-                except Exception as e:
-                    error_msg = f"处理第 {i} 页时发生错误: {str(e)}"
-                    tqdm.write(error_msg)
-                    
-                    if error_strategy == 'abort':
-                        raise Exception(f"由于错误策略设置为'abort'，停止处理。最后错误: {str(e)}")
-                    
-                    # 记录错误信息到文件
-                    with open(output_path, 'a', encoding='utf-8') as f:
-                        f.write(f"# Page {i}\n\n")
-                        f.write("## 原文\n")
-                        f.write(page_text + "\n\n")
-                        f.write("## 内容解读\n")
-                        f.write(f"生成失败: {str(e)}\n\n")
-                    
-                    # 更新进度条
-                    pbar.update(1)
-                    self.update_progress_stats(pbar)
+                        # 按页码顺序写入已完成的连续页面
+                        while next_page in notes:
+                            f.write(notes.pop(next_page))
+                            next_page += 1
+                        
+                        # 更新统计信息和进度条
+                        self.update_progress_stats(pbar)
+                        pbar.update(len(pages))
 
         # 处理完成后打印详细统计信息
         print("\n处理完成！")
         self.print_final_stats()
 
+    def process_page_group(self, pages: List[Tuple[int, str]], topic: str) -> List[str]:
+        """处理一组相邻页面，合并为一次API调用，返回每页格式化的笔记"""
+        if len(pages) == 1:
+            return [self.process_single_page(*pages[0], topic)]
+        
+        prompt = self.create_batch_prompt([page_text for _, page_text in pages], topic)
+        response, finish_reason = self.call_llm_api_with_finish_reason(prompt)
+        page_range = f"{pages[0][0]}-{pages[-1][0]}"
+        
+        # 输出被截断或返回格式不符时退回逐页处理
+        if finish_reason == 'length':
+            tqdm.write(f"第 {page_range} 页合并调用的输出超出max_tokens被截断，改为逐页处理")
+            analyses = None
+        else:
+            analyses = self.parse_batch_response(response, len(pages))
+            if analyses is None:
+                tqdm.write(f"第 {page_range} 页合并结果解析失败，改为逐页处理")
+        
+        if analyses is None:
+            return [self.process_single_page(page_num, page_text, topic) for page_num, page_text in pages]
+        
+        return [
+            self.format_page_note(page_num, page_text, analysis)
+            for (page_num, page_text), analysis in zip(pages, analyses)
+        ]
+
     def process_single_page(self, page_num: int, page_text: str, topic: str) -> str:
         """处理单个页面并返回格式化的笔记"""
+        prompt = self.create_prompt(page_text, topic)
+        response = self.call_llm_api(prompt)
+        return self.format_page_note(page_num, page_text, response)
+
+    def format_page_note(self, page_num: int, page_text: str, analysis: str) -> str:
+        """将原文和解读内容格式化为单页笔记"""
         notes = []
         
         # 添加页码标题（一级标题）
@@ -353,11 +452,9 @@ class NotesGenerator:
         notes.append("## 原文\n")
         notes.append(page_text + "\n\n")
         
-        # 生成内容解读部分（二级标题）
+        # 添加内容解读部分（二级标题）
         notes.append("## 内容解读\n")
-        prompt = self.create_prompt(page_text, topic)
-        response = self.call_llm_api(prompt)
-        notes.append(response + "\n\n")
+        notes.append(analysis + "\n\n")
         
         return "\n".join(notes)
 
@@ -391,8 +488,8 @@ def main():
         
         # 如果指定了统计文件，保存统计信息
         if args.save_stats:
-            with open(args.save_stats, 'w', encoding='utf-8') as f:
-                json.dump(generator.usage_stats, f, indent=2, ensure_ascii=False)
+            with open(args.save_stats, 'wb') as f:
+                f.write(orjson.dumps(generator.usage_stats, option=orjson.OPT_INDENT_2))
             print(f"\n统计信息已保存到: {args.save_stats}")
         
     except Exception as e: